@@ -19,6 +19,7 @@ import dataclasses
 import os
 import signal
 import subprocess
+import sys
 import tempfile
 import threading
 from typing import Dict, List, Optional, Tuple
@@ -183,9 +184,16 @@ def start_cancellable_process(
     command_env['TF_CPP_MIN_LOG_LEVEL'] = '1'
   else:
     logging.info(cmdline)
+  # Before Python 3.10, Popen forks (copying the page tables of a possibly
+  # large worker process) unless it can take its posix_spawn fast path, which
+  # requires close_fds=False. From 3.10 on, it uses vfork even with
+  # close_fds=True, so keep the safer default there. Note that with
+  # close_fds=False, file descriptors opened without O_CLOEXEC - e.g. by native
+  # libraries - are inherited by the child.
   with subprocess.Popen(
       cmdline,
       env=command_env,
+      close_fds=sys.version_info >= (3, 10),
       stdout=(subprocess.PIPE if want_output else None)) as p:
     if cancellation_manager:
       cancellation_manager.register_process(p)
@@ -28,6 +28,11 @@ import tensorflow as tf
 
 from compiler_opt.rl import constant
 
+# Number of threads used to fetch the module sizes and command lines when
+# loading a corpus. That work is I/O bound (and possibly remote), so it benefits
+# from more threads than there are cores.
+_LOAD_THREADS = 32
+
 # Alias to better self-document APIs. Represents a complete, ready to use
 # command line, where all the flags reference existing, local files.
 FullyQualifiedCmdLine = Tuple[str, ...]
@@ -327,7 +332,7 @@ class Corpus:
           replace_flags=replace_flags)
 
     # perform concurrently because fetching file size may be slow (remote)
-    with concurrent.futures.ThreadPoolExecutor() as tp:
+    with concurrent.futures.ThreadPoolExecutor(_LOAD_THREADS) as tp:
       contents = tp.map(
           lambda name: ModuleSpec(
               name=name,
@@ -14,18 +14,28 @@
 # limitations under the License.
 """Generate initial training data from the behavior of the current heuristic."""
 
+import concurrent.futures
 import contextlib
 import functools
+import hashlib
+import heapq
 import os
+import pickle
 import queue
 import re
+import struct
 import subprocess
-from typing import Dict, List, Optional, Union, Tuple  # pylint:disable=unused-import
+import sys
+import tempfile
+import threading
+import zlib
+from typing import Callable, Dict, List, Optional, Union, Tuple  # pylint:disable=unused-import
 
 from absl import app
 from absl import flags
 from absl import logging
 import gin
+import google_crc32c
 import multiprocessing
 import tensorflow as tf
 
@@ -46,6 +56,11 @@ _OUTPUT_PATH = flags.DEFINE_string(
 _OUTPUT_PERFORMANCE_PATH = flags.DEFINE_string(
     'output_performance_path', None,
     'Path to the output performance file if not None.')
+_NUM_OUTPUT_SHARDS = flags.DEFINE_integer(
+    'num_output_shards', 1,
+    'Number of files the output tfrecord is split into, each written by its '
+    'own thread. With more than 1, the files are named '
+    '<output_path>-<shard>-of-<num_output_shards>.')
 _NUM_WORKERS = flags.DEFINE_integer(
     'num_workers', None,
     'Number of parallel workers for compilation. `None` for maximum available.')
@@ -59,16 +74,385 @@ _MODULE_FILTER = flags.DEFINE_string(
 _KEY_FILTER = flags.DEFINE_string(
     'key_filter', None,
     'Regex for key names to include, do not provide one to include all')
+_MODULE_CACHE_DIR = flags.DEFINE_string(
+    'module_cache_dir', None,
+    'Local directory where loaded modules are cached across runs, e.g. under '
+    '/dev/shm. Entries are keyed on the size and modification time of the '
+    'module files. Mostly useful when data_path is remote.')
+_MODULE_CACHE_MAX_MB = flags.DEFINE_integer(
+    'module_cache_max_mb', 4096,
+    'Maximum size of module_cache_dir, in MB. At the end of each run, least '
+    'recently used entries are evicted beyond it, e.g. stale copies of modules '
+    'that were since edited.')
 _GIN_FILES = flags.DEFINE_multi_string(
     'gin_files', [], 'List of paths to gin configuration files.')
 _GIN_BINDINGS = flags.DEFINE_multi_string(
     'gin_bindings', [],
     'Gin bindings to override the values set in the config files.')
 
-ResultsQueueEntry = Union[Optional[Tuple[str, List[str],
-                                         Dict[str,
-                                              compilation_runner.RewardStat]]],
-                          BaseException]
+# Buffer size used when writing outputs to local files.
+_LOCAL_WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+# Limits on how many queued modules are written to a local output shard with a
+# single writev call.
+_WRITEV_MAX_BUFFERS = 64
+_WRITEV_MAX_BYTES = 16 * 1024 * 1024
+
+# Key filters that just list names, e.g. `^(foo|bar)$` or `^foo$`.
+_LITERAL_KEY_FILTER = re.compile(r'\^?(?:\(([\w|-]+)\)|([\w-]+))\$')
+
+# google_crc32c computes CRC32C with the SSE4.2 / ARMv8 CRC instructions when
+# its C extension is available. Its pure Python fallback is much slower than
+# the native framing done by tf.io.TFRecordWriter, so that is used instead.
+_HAS_NATIVE_CRC32C = google_crc32c.implementation == 'c'
+
+# Records of a module: framed by frame_records if _HAS_NATIVE_CRC32C, else the
+# list of serialized records, to be written with a tf.io.TFRecordWriter.
+ModuleRecords = Union[bytes, List[bytes]]
+
+# (module name, records, number of records, performance rows), or None if the
+# module failed to compile.
+CollectResult = Optional[Tuple[str, ModuleRecords, int, str]]
+ResultsQueueEntry = Union[CollectResult, BaseException]
+ModuleSpecLoader = Callable[[corpus.ModuleSpec], corpus.LoadedModuleSpec]
+
+# Per-process state of the workers, set up once by `_init_worker`.
+_load_module_spec: Optional[ModuleSpecLoader] = None
+_runner: Optional[compilation_runner.CompilationRunner] = None
+_policy: Optional[policy_saver.Policy] = None
+_key_filter: Optional[Callable[[str], bool]] = None
+_write_records = False
+_write_performance = False
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_filter(pattern: Optional[str]) -> Optional['re.Pattern[str]']:
+  """Compiles a filter regex once per pattern, or returns None for no filter."""
+  return re.compile(pattern) if pattern else None
+
+
+def _is_local_path(path: str) -> bool:
+  """Whether `path` is on the local filesystem, as opposed to e.g. gs://."""
+  return '://' not in path
+
+
+def _open_text_output(path: str):
+  """Opens `path` for writing text, bypassing tf.io.gfile for local files."""
+  if _is_local_path(path):
+    return open(path, 'w', buffering=_LOCAL_WRITE_BUFFER_SIZE, encoding='utf-8')
+  return tf.io.gfile.GFile(path, 'w')
+
+
+def _masked_crc32c(data: bytes) -> bytes:
+  crc = google_crc32c.value(data)
+  return struct.pack('<I',
+                     (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff)
+
+
+def frame_records(records: List[bytes]) -> bytes:
+  """Returns `records` in the tfrecord format, concatenated.
+
+  Each record is framed as: its length (uint64), the masked CRC32C of the
+  length, the record, and the masked CRC32C of the record - all little-endian.
+  Writing the result to a file is equivalent to writing each record with a
+  tf.io.TFRecordWriter, but takes a single write call.
+  """
+  frames = []
+  for record in records:
+    length = struct.pack('<Q', len(record))
+    frames.extend(
+        (length, _masked_crc32c(length), record, _masked_crc32c(record)))
+  return b''.join(frames)
+
+
+def _writev_all(fd: int, buffers: List[bytes]):
+  """Writes all of `buffers` to `fd`, retrying after partial writes."""
+  views = [memoryview(b) for b in buffers]
+  while views:
+    written = os.writev(fd, views)
+    while views and written >= len(views[0]):
+      written -= len(views[0])
+      views.pop(0)
+    if written:
+      views[0] = views[0][written:]
+
+
+class ShardedTFRecordWriter:
+  """Writes records to a set of tfrecord files, with one thread per file.
+
+  All the records of a module go to the same shard, picked by a stable hash of
+  the module name. The files are opened at construction, so a bad output path is
+  reported right away. Use as a context manager: exiting waits for all the
+  queued records to be written, and re-raises any error from the writer
+  threads. `write` raises promptly if the writer of its shard has failed.
+
+  A module's records are expected framed by frame_records, unless there is no
+  native CRC32C. Then they are a list of serialized records, written with
+  tf.io.TFRecordWriter.
+  """
+
+  def __init__(self, output_path: str, num_shards: int):
+    if num_shards < 1:
+      raise ValueError(f'num_shards must be at least 1, got {num_shards}.')
+    self._paths = [output_path] if num_shards == 1 else [
+        f'{output_path}-{i:05d}-of-{num_shards:05d}' for i in range(num_shards)
+    ]
+    self._queues: List['queue.Queue[Optional[ModuleRecords]]'] = [
+        queue.Queue() for _ in self._paths
+    ]
+    self._outputs = []
+    try:
+      for path in self._paths:
+        self._outputs.append(self._open_shard(path))
+    except BaseException:
+      self._close_outputs()
+      raise
+    self._executor = None
+    self._futures = []
+
+  @property
+  def paths(self) -> List[str]:
+    return self._paths
+
+  def __enter__(self):
+    self._executor = concurrent.futures.ThreadPoolExecutor(len(self._paths))
+    self._futures = [
+        self._executor.submit(self._write_shard, output, q)
+        for output, q in zip(self._outputs, self._queues)
+    ]
+    return self
+
+  def __exit__(self, *args):
+    for q in self._queues:
+      q.put(None)
+    self._executor.shutdown(wait=True)
+    self._close_outputs()
+    for f in self._futures:
+      f.result()
+
+  @staticmethod
+  def _open_shard(path: str):
+    """Returns a TFRecordWriter without native CRC32C, else a fd or a GFile.
+
+    Local shards are written with os.writev, where available, and other ones
+    through tf.io.gfile.
+    """
+    if not _HAS_NATIVE_CRC32C:
+      return tf.io.TFRecordWriter(path)
+    if _is_local_path(path) and hasattr(os, 'writev'):
+      return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    return tf.io.gfile.GFile(path, 'wb')
+
+  def _close_outputs(self):
+    outputs, self._outputs = self._outputs, []
+    for output in outputs:
+      if isinstance(output, int):
+        os.close(output)
+      else:
+        output.close()
+
+  @staticmethod
+  def _write_shard(output, q: 'queue.Queue[Optional[ModuleRecords]]'):
+    if isinstance(output, tf.io.TFRecordWriter):
+      while (records := q.get()) is not None:
+        for record in records:
+          output.write(record)
+      return
+    if not isinstance(output, int):
+      while (framed_records := q.get()) is not None:
+        output.write(framed_records)
+      return
+    finished = False
+    while not finished and (framed_records := q.get()) is not None:
+      # Write whatever else is already queued with the same syscall.
+      buffers = [framed_records]
+      size = len(framed_records)
+      while len(buffers) < _WRITEV_MAX_BUFFERS and size < _WRITEV_MAX_BYTES:
+        try:
+          framed_records = q.get_nowait()
+        except queue.Empty:
+          break
+        if framed_records is None:
+          finished = True
+          break
+        buffers.append(framed_records)
+        size += len(framed_records)
+      _writev_all(output, buffers)
+
+  def write(self, module_name: str, records: ModuleRecords):
+    """Queues the records of `module_name`, as returned by _collect."""
+    # Unlike hash(), crc32 is not salted per process, so a given corpus is
+    # sharded the same way on every run.
+    shard = zlib.crc32(module_name.encode('utf-8')) % len(self._queues)
+    # Don't let records pile up in memory behind a writer that has stopped.
+    if self._futures[shard].done():
+      self._futures[shard].result()
+      raise RuntimeError(f'The writer of {self._paths[shard]} has stopped.')
+    self._queues[shard].put(records)
+
+
+def partition_by_size(module_specs: List[corpus.ModuleSpec],
+                      num_partitions: int) -> List[List[corpus.ModuleSpec]]:
+  """Partitions `module_specs` into lists of roughly equal total size.
+
+  This is the Longest-Processing-Time-first schedule: going from the largest
+  module to the smallest, each module is assigned to the partition with the
+  smallest total size so far. Each partition ends up sorted by size,
+  descending.
+  """
+  partitions = [[] for _ in range(num_partitions)]
+  loads = [(0, i) for i in range(num_partitions)]
+  for module_spec in sorted(module_specs, key=lambda m: m.size, reverse=True):
+    load, i = heapq.heappop(loads)
+    partitions[i].append(module_spec)
+    heapq.heappush(loads, (load + module_spec.size, i))
+  return partitions
+
+
+class WorkStealingQueues:
+  """Per-worker work queues, from which idle workers steal.
+
+  The work is partitioned upfront, one list per worker, and shared with all
+  the worker processes. Each queue is the range [head, tail) of its list; the
+  bounds live in shared memory and are guarded by a per-queue lock. A worker
+  takes items one at a time from the front of its own queue. Once that is
+  empty, it steals half of the remaining items from the back of another
+  worker's queue.
+  """
+
+  def __init__(self, ctx, partitions: List[List[corpus.ModuleSpec]]):
+    self._partitions = partitions
+    self._heads = ctx.RawArray('q', len(partitions))
+    self._tails = ctx.RawArray('q', [len(p) for p in partitions])
+    self._locks = [ctx.Lock() for _ in partitions]
+
+  def get(self, worker_index: int) -> List[corpus.ModuleSpec]:
+    """Returns the next items for `worker_index`, or [] if all work is taken."""
+    with self._locks[worker_index]:
+      head = self._heads[worker_index]
+      if head < self._tails[worker_index]:
+        self._heads[worker_index] = head + 1
+        return [self._partitions[worker_index][head]]
+    num_queues = len(self._partitions)
+    for offset in range(1, num_queues):
+      victim = (worker_index + offset) % num_queues
+      with self._locks[victim]:
+        remaining = self._tails[victim] - self._heads[victim]
+        if remaining <= 0:
+          continue
+        tail = self._tails[victim]
+        self._tails[victim] = tail - max(1, remaining // 2)
+        return self._partitions[victim][self._tails[victim]:tail]
+    return []
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_key_filter(
+    pattern: Optional[str]) -> Optional[Callable[[str], bool]]:
+  """Returns a predicate for the key names to include, or None for all.
+
+  A pattern that only lists literal names, like `^(foo|bar)$`, is turned into
+  a set lookup instead of a regex match.
+  """
+  if not pattern:
+    return None
+  if literal_match := _LITERAL_KEY_FILTER.fullmatch(pattern):
+    names = frozenset((literal_match.group(1) or
+                       literal_match.group(2)).split('|'))
+    # `$` also matches right before a trailing newline.
+    return lambda key: key in names or (key[-1:] == '\n' and key[:-1] in names)
+  return _compile_filter(pattern).match
+
+
+class CachedModuleSpecLoader:
+  """Wraps a ModuleSpecLoader with a content-addressed on-disk cache.
+
+  The cache key is a hash of the ModuleSpec and of the path, size and
+  modification time of the module's files, so editing a module or changing
+  its command line invalidates its entry. Entries are written atomically, so
+  concurrent workers and interrupted runs never leave partial entries. `evict`
+  removes the least recently used entries beyond `max_bytes`; it scans the whole
+  cache, so it is meant to be called once per run rather than per entry.
+
+  The cache is best-effort: an unreadable entry is treated as a miss, and a
+  failure to store an entry is logged and otherwise ignored.
+  """
+
+  def __init__(self, load_module_spec: ModuleSpecLoader, data_path: str,
+               cache_dir: str, max_bytes: int):
+    self._load_module_spec = load_module_spec
+    self._data_path = data_path
+    self._cache_dir = cache_dir
+    self._max_bytes = max_bytes
+
+  def _cache_path(self, module_spec: corpus.ModuleSpec) -> str:
+    suffixes = ['.bc'] + (['.thinlto.bc'] if module_spec.has_thinlto else [])
+    key = [repr(module_spec)]
+    for suffix in suffixes:
+      path = os.path.join(self._data_path, module_spec.name + suffix)
+      stat = tf.io.gfile.stat(path)
+      key.append(f'{path}:{stat.length}:{stat.mtime_nsec}')
+    digest = hashlib.sha256('\0'.join(key).encode('utf-8')).hexdigest()
+    return os.path.join(self._cache_dir, digest + '.pickle')
+
+  def __call__(self, module_spec: corpus.ModuleSpec) -> corpus.LoadedModuleSpec:
+    cache_path = self._cache_path(module_spec)
+    try:
+      with open(cache_path, 'rb') as f:
+        loaded_module_spec = pickle.load(f)
+      # Mark the entry as recently used, for eviction.
+      os.utime(cache_path)
+      return loaded_module_spec
+    except FileNotFoundError:
+      pass
+    except Exception as e:  # pylint: disable=broad-except
+      # e.g. a corrupted entry, or one pickled by an incompatible version.
+      logging.warning('Ignoring unreadable module cache entry %s: %s',
+                      cache_path, e)
+    loaded_module_spec = self._load_module_spec(module_spec)
+    self._store(cache_path, loaded_module_spec)
+    return loaded_module_spec
+
+  def _store(self, cache_path: str,
+             loaded_module_spec: corpus.LoadedModuleSpec):
+    temp_path = None
+    try:
+      os.makedirs(self._cache_dir, exist_ok=True)
+      with tempfile.NamedTemporaryFile(dir=self._cache_dir, delete=False) as f:
+        temp_path = f.name
+        pickle.dump(loaded_module_spec, f, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(temp_path, cache_path)
+      temp_path = None
+    except (OSError, pickle.PicklingError) as e:
+      logging.warning('Failed to store %s in the module cache: %s',
+                      loaded_module_spec.name, e)
+    finally:
+      if temp_path:
+        with contextlib.suppress(OSError):
+          os.remove(temp_path)
+
+  def evict(self):
+    """Removes least recently used entries until the cache fits max_bytes."""
+    entries = []
+    try:
+      with os.scandir(self._cache_dir) as it:
+        for entry in it:
+          if not entry.name.endswith('.pickle'):
+            continue
+          try:
+            stat = entry.stat()
+          except FileNotFoundError:
+            continue
+          entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    except OSError as e:
+      logging.warning('Failed to list the module cache: %s', e)
+      return
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total_bytes <= self._max_bytes:
+        break
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+      total_bytes -= size
 
 
 def get_runner() -> compilation_runner.CompilationRunner:
@@ -76,59 +460,113 @@ def get_runner() -> compilation_runner.CompilationRunner:
   return problem_config.get_runner_type()(moving_average_decay_rate=0)
 
 
-def worker(policy_path: Optional[str],
-           work_queue: 'queue.Queue[corpus.LoadedModuleSpec]',
-           results_queue: 'queue.Queue[ResultsQueueEntry]',
-           key_filter: Optional[str]):
+def _init_worker(load_module_spec: ModuleSpecLoader,
+                 policy: Optional[policy_saver.Policy],
+                 key_filter: Optional[str], write_records: bool,
+                 write_performance: bool):
+  """Initializes a worker process.
+
+  The runner and the key filter are created once per process and reused for
+  every module the process handles. Modules are loaded with `load_module_spec`
+  in the worker, so only their ModuleSpec is sent over from the parent.
+
+  Args:
+    load_module_spec: loads a module of the corpus.
+    policy: the policy to generate trace with, or None.
+    key_filter: regex filter for key names to include, or None to include all.
+    write_records: whether the sequence examples are written out.
+    write_performance: whether the performance CSV is written out.
+  """
+  # pylint: disable=global-statement
+  global _load_module_spec, _runner, _policy, _key_filter
+  global _write_records, _write_performance
+  _load_module_spec = load_module_spec
+  _runner = get_runner()
+  _policy = policy
+  _key_filter = _compile_key_filter(key_filter)
+  _write_records = write_records
+  _write_performance = write_performance
+
+
+def _collect(module_spec: corpus.ModuleSpec) -> CollectResult:
+  """Describes the job each paralleled worker process does for one module.
+
+  Args:
+    module_spec: the module to load and compile.
+
+  Returns:
+    A tuple (module name, sequence examples, number of sequence examples,
+    performance CSV rows), or None if the module failed to compile. When
+    google_crc32c is native, the sequence examples are framed here, so they
+    travel to the parent as a single bytes object; otherwise, they are left as
+    a list for tf.io.TFRecordWriter to frame. The rows are formatted here too.
+    Outputs that are not written out are left empty.
+  """
+  loaded_module_spec = _load_module_spec(module_spec)
+  try:
+    data = _runner.collect_data(
+        loaded_module_spec=loaded_module_spec,
+        policy=_policy,
+        reward_stat=None,
+        model_id=0)
+  except (subprocess.CalledProcessError, subprocess.TimeoutExpired,
+          RuntimeError):
+    logging.error('Failed to compile %s.', module_spec.name)
+    return None
+  # The IR is no longer needed; release it before framing copies the records.
+  del loaded_module_spec
+  sequence_examples = data.serialized_sequence_examples
+  reward_stats = data.reward_stats
+  if _key_filter:
+    # Bind to a local, to avoid a global lookup per key.
+    key_filter = _key_filter
+    kept = [(k, sequence_example)
+            for k, sequence_example in zip(data.keys, sequence_examples)
+            if key_filter(k)]
+    sequence_examples = [sequence_example for _, sequence_example in kept]
+    reward_stats = {k: reward_stats[k] for k, _ in kept}
+  performance_rows = ''
+  if _write_performance:
+    performance_rows = ''.join(
+        f'{module_spec.name},{key},{value.default_reward},'
+        f'{value.moving_average_reward}\n'
+        for key, value in reward_stats.items())
+  records = b''
+  if _write_records:
+    records = (
+        frame_records(sequence_examples)
+        if _HAS_NATIVE_CRC32C else sequence_examples)
+  return (module_spec.name, records, len(sequence_examples), performance_rows)
+
+
+def worker(load_module_spec: ModuleSpecLoader,
+           policy: Optional[policy_saver.Policy], key_filter: Optional[str],
+           write_records: bool, write_performance: bool,
+           work_queues: WorkStealingQueues, worker_index: int,
+           results_queue: 'multiprocessing.SimpleQueue[ResultsQueueEntry]'):
   """Describes the job each paralleled worker process does.
 
-  The worker picks a workitem from the work_queue, process it, and deposits
-  a result on the results_queue, in either success or failure cases.
-  The results_queue items are tuples (workitem, result). On failure, the result
-  is None.
+  The worker takes work from `work_queues`, processes it, and deposits a
+  result on the results_queue for each module, in either success or failure
+  cases. On failure, the result is None. If the worker itself fails, the
+  exception is deposited instead.
 
   Args:
-    runner: the data collector.
-    policy_path: the policy_path to generate trace with.
-    work_queue: the queue of unprocessed work items.
-    results_queue: the queue where results are deposited.
+    load_module_spec: loads a module of the corpus.
+    policy: the policy to generate trace with, or None.
     key_filter: regex filter for key names to include, or None to include all.
+    write_records: whether the sequence examples are written out.
+    write_performance: whether the performance CSV is written out.
+    work_queues: the queues of unprocessed module specs.
+    worker_index: the index of this worker's own queue in `work_queues`.
+    results_queue: the queue where results are deposited.
   """
   try:
-    runner = get_runner()
-    m = re.compile(key_filter) if key_filter else None
-    policy = policy_saver.Policy.from_filesystem(
-        policy_path) if policy_path else None
-    while True:
-      try:
-        loaded_module_spec = work_queue.get_nowait()
-      except queue.Empty:
-        return
-      try:
-        data = runner.collect_data(
-            loaded_module_spec=loaded_module_spec,
-            policy=policy,
-            reward_stat=None,
-            model_id=0)
-        if not m:
-          results_queue.put(
-              (loaded_module_spec.name, data.serialized_sequence_examples,
-               data.reward_stats))
-          continue
-        new_reward_stats = {}
-        new_sequence_examples = []
-        for k, sequence_example in zip(data.keys,
-                                       data.serialized_sequence_examples):
-          if not m.match(k):
-            continue
-          new_reward_stats[k] = data.reward_stats[k]
-          new_sequence_examples.append(sequence_example)
-        results_queue.put(
-            (loaded_module_spec.name, new_sequence_examples, new_reward_stats))
-      except (subprocess.CalledProcessError, subprocess.TimeoutExpired,
-              RuntimeError):
-        logging.error('Failed to compile %s.', loaded_module_spec.name)
-        results_queue.put(None)
+    _init_worker(load_module_spec, policy, key_filter, write_records,
+                 write_performance)
+    while module_specs := work_queues.get(worker_index):
+      for module_spec in module_specs:
+        results_queue.put(_collect(module_spec))
   except BaseException as e:  # pylint: disable=broad-except
     results_queue.put(e)
 
@@ -142,13 +580,11 @@ def main(_):
   config = registry.get_configuration()
 
   logging.info('Loading module specs from corpus.')
-  module_filter = re.compile(
-      _MODULE_FILTER.value) if _MODULE_FILTER.value else None
+  module_filter = _compile_filter(_MODULE_FILTER.value)
 
   cps = corpus.Corpus(
       data_path=_DATA_PATH.value,
-      module_filter=lambda name: True
-      if not module_filter else module_filter.match(name),
+      module_filter=module_filter.match if module_filter else None,
       additional_flags=config.flags_to_add(),
       delete_flags=config.flags_to_delete(),
       replace_flags=config.flags_to_replace())
@@ -160,72 +596,108 @@ def main(_):
   # other smaller files are processed in parallel
   corpus_elements = cps.sample(k=sampled_modules, sort=True)
 
+  if _OUTPUT_PATH.value and not _HAS_NATIVE_CRC32C:
+    logging.warning('google_crc32c has no native implementation here, '
+                    'falling back to tf.io.TFRecordWriter.')
+
+  load_module_spec = cps.load_module_spec
+  module_cache = None
+  if _MODULE_CACHE_DIR.value:
+    module_cache = CachedModuleSpecLoader(
+        load_module_spec, _DATA_PATH.value, _MODULE_CACHE_DIR.value,
+        _MODULE_CACHE_MAX_MB.value * 1024 * 1024)
+    load_module_spec = module_cache
+
+  policy = policy_saver.Policy.from_filesystem(
+      _POLICY_PATH.value) if _POLICY_PATH.value else None
+
   worker_count = (
       min(os.cpu_count(), _NUM_WORKERS.value)
       if _NUM_WORKERS.value else os.cpu_count())
 
   tfrecord_context = (
-      tf.io.TFRecordWriter(_OUTPUT_PATH.value)
+      ShardedTFRecordWriter(_OUTPUT_PATH.value, _NUM_OUTPUT_SHARDS.value)
       if _OUTPUT_PATH.value else contextlib.nullcontext())
   performance_context = (
-      tf.io.gfile.GFile(_OUTPUT_PERFORMANCE_PATH.value, 'w')
+      _open_text_output(_OUTPUT_PERFORMANCE_PATH.value)
       if _OUTPUT_PERFORMANCE_PATH.value else contextlib.nullcontext())
 
-  with tfrecord_context as tfrecord_writer:
-    with performance_context as performance_writer:
-      ctx = multiprocessing.get_context()
-      m = ctx.Manager()
-      results_queue: 'queue.Queue[ResultsQueueEntry]' = m.Queue()
-      work_queue: 'queue.Queue[corpus.LoadedModuleSpec]' = m.Queue()
-      for corpus_element in corpus_elements:
-        work_queue.put(cps.load_module_spec(corpus_element))
-
-      # pylint:disable=g-complex-comprehension
-      processes = [
-          ctx.Process(
-              target=functools.partial(worker, _POLICY_PATH.value, work_queue,
-                                       results_queue, _KEY_FILTER.value))
-          for _ in range(0, worker_count)
-      ]
-      # pylint:enable=g-complex-comprehension
-
-      for p in processes:
-        p.start()
-
-      total_successful_examples = 0
-      total_work = len(corpus_elements)
-      total_failed_examples = 0
-      total_training_examples = 0
-      for _ in range(total_work):
-        logging.log_every_n_seconds(logging.INFO,
-                                    '%d success, %d failed out of %d', 10,
-                                    total_successful_examples,
-                                    total_failed_examples, total_work)
-
-        results = results_queue.get()
-        if isinstance(results, BaseException):
-          logging.fatal(results)
-        if not results:
-          total_failed_examples += 1
-          continue
+  total_successful_examples = 0
+  total_work = len(corpus_elements)
+  total_failed_examples = 0
+  total_training_examples = 0
+  # Start the workers before the output writer threads, so no thread is
+  # running when they are forked. Forking, on Linux, also lets the workers share
+  # the parent's imported modules and loaded policy, instead of each
+  # re-importing TensorFlow. Elsewhere, e.g. on macOS where forking after
+  # loading system frameworks is unsafe, keep the default start method.
+  ctx = multiprocessing.get_context(
+      'fork' if sys.platform.startswith('linux') else None)
+  work_queues = WorkStealingQueues(
+      ctx, partition_by_size(corpus_elements, worker_count))
+  results_queue: 'multiprocessing.SimpleQueue[ResultsQueueEntry]' = (
+      ctx.SimpleQueue())
+  processes = [
+      ctx.Process(
+          target=worker,
+          args=(load_module_spec, policy, _KEY_FILTER.value,
+                bool(_OUTPUT_PATH.value), bool(_OUTPUT_PERFORMANCE_PATH.value),
+                work_queues, i, results_queue)) for i in range(worker_count)
+  ]
+  for p in processes:
+    p.start()
+
+  # Report progress from a separate thread, rather than checking the time for
+  # every result.
+  done = threading.Event()
+
+  def log_progress():
+    while not done.wait(10):
+      logging.info('%d success, %d failed out of %d', total_successful_examples,
+                   total_failed_examples, total_work)
+
+  threading.Thread(target=log_progress, daemon=True).start()
+
+  try:
+    with tfrecord_context as tfrecord_writer:
+      with performance_context as performance_writer:
+        for _ in range(total_work):
+          results = results_queue.get()
+          if isinstance(results, BaseException):
+            logging.fatal(results)
+          if not results:
+            total_failed_examples += 1
+            continue
+
+          total_successful_examples += 1
+          module_name, records, num_records, performance_rows = results
+          if tfrecord_writer:
+            total_training_examples += num_records
+            tfrecord_writer.write(module_name, records)
+          if performance_writer:
+            performance_writer.write(performance_rows)
+          # Don't keep this module's records alive while waiting for the next
+          # result.
+          del results, records, performance_rows
+  except BaseException:
+    # Nothing reads the results anymore, so the workers may block putting
+    # theirs; and, as they are not daemons, the interpreter would wait for them
+    # at exit instead of reporting the error.
+    for p in processes:
+      p.terminate()
+    for p in processes:
+      p.join()
+    raise
+  finally:
+    done.set()
 
-        total_successful_examples += 1
-        module_name, records, reward_stat = results
-        if tfrecord_writer:
-          total_training_examples += len(records)
-          for r in records:
-            tfrecord_writer.write(r)
-        if performance_writer:
-          for key, value in reward_stat.items():
-            performance_writer.write(
-                (f'{module_name},{key},{value.default_reward},'
-                 f'{value.moving_average_reward}\n'))
-
-      print((f'{total_successful_examples} of {len(corpus_elements)} modules '
-             f'succeeded, and {total_training_examples} trainining examples '
-             'written'))
-      for p in processes:
-        p.join()
+  print((f'{total_successful_examples} of {len(corpus_elements)} modules '
+         f'succeeded, and {total_training_examples} trainining examples '
+         'written'))
+  for p in processes:
+    p.join()
+  if module_cache:
+    module_cache.evict()
 
 
 if __name__ == '__main__':
@@ -13,8 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Tests for generate_default_trace."""
+# pylint: disable=protected-access
 import json
+import multiprocessing
 import os
+import re
+import zlib
 from unittest import mock
 
 from absl import flags
@@ -26,6 +30,7 @@ import tensorflow as tf
 # This is https://github.com/google/pytype/issues/764
 from google.protobuf import text_format  # pytype: disable=pyi-error
 from compiler_opt.rl import compilation_runner
+from compiler_opt.rl import corpus
 from compiler_opt.tools import generate_default_trace
 
 flags.FLAGS['num_workers'].allow_override = True
@@ -63,6 +68,19 @@ class MockCompilationRunner(compilation_runner.CompilationRunner):
         model_id=model_id)
 
 
+def _create_test_corpus(path, module_names):
+  with tf.io.gfile.GFile(os.path.join(path, 'corpus_description.json'),
+                         'w') as f:
+    json.dump({'modules': module_names, 'has_thinlto': False}, f)
+
+  for module_name in module_names:
+    with tf.io.gfile.GFile(os.path.join(path, module_name + '.bc'), 'w') as f:
+      f.write(module_name)
+
+    with tf.io.gfile.GFile(os.path.join(path, module_name + '.cmd'), 'w') as f:
+      f.write('-cc1')
+
+
 class GenerateDefaultTraceTest(absltest.TestCase):
 
   def setUp(self):
@@ -76,20 +94,7 @@ class GenerateDefaultTraceTest(absltest.TestCase):
   def test_api(self, mock_get_runner):
 
     tmp_dir = self.create_tempdir()
-    module_names = ['a', 'b', 'c', 'd']
-
-    with tf.io.gfile.GFile(
-        os.path.join(tmp_dir.full_path, 'corpus_description.json'), 'w') as f:
-      json.dump({'modules': module_names, 'has_thinlto': False}, f)
-
-    for module_name in module_names:
-      with tf.io.gfile.GFile(
-          os.path.join(tmp_dir.full_path, module_name + '.bc'), 'w') as f:
-        f.write(module_name)
-
-      with tf.io.gfile.GFile(
-          os.path.join(tmp_dir.full_path, module_name + '.cmd'), 'w') as f:
-        f.write('-cc1')
+    _create_test_corpus(tmp_dir.full_path, ['a', 'b', 'c', 'd'])
 
     mock_compilation_runner = MockCompilationRunner()
     mock_get_runner.return_value = mock_compilation_runner
@@ -103,6 +108,198 @@ class GenerateDefaultTraceTest(absltest.TestCase):
     ):
       generate_default_trace.main(None)
 
+    with open(
+        os.path.join(tmp_dir.full_path, 'output_performance'),
+        encoding='utf-8') as f:
+      self.assertCountEqual(
+          f.read().splitlines(),
+          ['a,default,1,2', 'b,default,1,2', 'c,default,1,2', 'd,default,1,2'])
+
+  @mock.patch('compiler_opt.tools.generate_default_trace.get_runner')
+  def test_sharded_output(self, mock_get_runner):
+    tmp_dir = self.create_tempdir()
+    _create_test_corpus(tmp_dir.full_path, ['a', 'b', 'c', 'd'])
+    mock_get_runner.return_value = MockCompilationRunner()
+    output_path = os.path.join(tmp_dir.full_path, 'output')
+
+    with flagsaver.flagsaver(
+        data_path=tmp_dir.full_path,
+        num_workers=2,
+        num_output_shards=3,
+        output_path=output_path):
+      generate_default_trace.main(None)
+
+    shards = [f'{output_path}-{i:05d}-of-00003' for i in range(3)]
+    self.assertCountEqual(tf.io.gfile.glob(output_path + '-*'), shards)
+    self.assertLen(list(tf.data.TFRecordDataset(shards)), 4)
+
+  @mock.patch('compiler_opt.tools.generate_default_trace.get_runner')
+  def test_failing_writer(self, mock_get_runner):
+    tmp_dir = self.create_tempdir()
+    _create_test_corpus(tmp_dir.full_path, ['a', 'b', 'c', 'd'])
+    mock_get_runner.return_value = MockCompilationRunner()
+
+    with flagsaver.flagsaver(
+        data_path=tmp_dir.full_path,
+        num_workers=2,
+        output_path=os.path.join(tmp_dir.full_path, 'output')):
+      with mock.patch.object(
+          generate_default_trace.ShardedTFRecordWriter,
+          'write',
+          side_effect=OSError('no space')):
+        with self.assertRaisesRegex(OSError, 'no space'):
+          generate_default_trace.main(None)
+    # The workers must not outlive main, or exiting would wait on them.
+    self.assertEmpty(multiprocessing.active_children())
+
+  def test_cached_module_spec_loader(self):
+    data_path = self.create_tempdir()
+    cache_dir = self.create_tempdir()
+    data_path.create_file('a.bc', content='ir')
+    module_spec = corpus.ModuleSpec(name='a', size=2)
+    load_module_spec = mock.Mock(side_effect=lambda m: corpus.LoadedModuleSpec(
+        name=m.name, loaded_ir=b'ir'))
+    loader = generate_default_trace.CachedModuleSpecLoader(
+        load_module_spec, data_path.full_path, cache_dir.full_path, 1024 * 1024)
+
+    expected = corpus.LoadedModuleSpec(name='a', loaded_ir=b'ir')
+    self.assertEqual(loader(module_spec), expected)
+    self.assertEqual(loader(module_spec), expected)
+    self.assertEqual(load_module_spec.call_count, 1)
+
+    # Changing the module invalidates the cache entry.
+    data_path.create_file('a.bc', content='new ir')
+    self.assertEqual(loader(module_spec), expected)
+    self.assertEqual(load_module_spec.call_count, 2)
+
+    # An unreadable entry is a cache miss, and gets replaced.
+    for entry in os.listdir(cache_dir.full_path):
+      with open(os.path.join(cache_dir.full_path, entry), 'wb') as f:
+        f.write(b'not a pickle')
+    self.assertEqual(loader(module_spec), expected)
+    self.assertEqual(load_module_spec.call_count, 3)
+    self.assertEqual(loader(module_spec), expected)
+    self.assertEqual(load_module_spec.call_count, 3)
+
+  def test_cached_module_spec_loader_eviction(self):
+    data_path = self.create_tempdir()
+    cache_dir = self.create_tempdir()
+    module_specs = [corpus.ModuleSpec(name=name, size=1000) for name in 'abc']
+    for module_spec in module_specs:
+      data_path.create_file(module_spec.name + '.bc', content='x' * 1000)
+    loader = generate_default_trace.CachedModuleSpecLoader(
+        lambda m: corpus.LoadedModuleSpec(name=m.name, loaded_ir=b'x' * 1000),
+        data_path.full_path, cache_dir.full_path, 2500)
+
+    cache_paths = [loader._cache_path(m) for m in module_specs]
+    for i, module_spec in enumerate(module_specs):
+      loader(module_spec)
+      # Use distinct times, as mtimes may come from a coarse clock.
+      os.utime(cache_paths[i], ns=(i * 10**9, i * 10**9))
+    # Storing entries doesn't evict.
+    self.assertLen(os.listdir(cache_dir.full_path), 3)
+
+    # Using 'a' makes 'b' the least recently used entry, and only 2 fit.
+    loader(module_specs[0])
+    loader.evict()
+    self.assertCountEqual(
+        os.listdir(cache_dir.full_path),
+        [os.path.basename(cache_paths[0]),
+         os.path.basename(cache_paths[2])])
+
+  def test_compile_key_filter(self):
+    self.assertIsNone(generate_default_trace._compile_key_filter(None))
+    keys = ['foo', 'bar', 'foobar', 'foo\n', 'baz', '', 'a-b']
+    for pattern in [
+        '^(foo|bar)$', '(foo|bar)$', '^foo$', '^(foo|)$', '^a-b$', 'foo',
+        '^fo+$', '^(foo|ba.)$', 'foo|bar$'
+    ]:
+      key_filter = generate_default_trace._compile_key_filter(pattern)
+      for key in keys:
+        self.assertEqual(
+            bool(key_filter(key)), bool(re.match(pattern, key)),
+            f'{pattern} on {key!r}')
+
+  def test_frame_records(self):
+    records = [b'', b'a', b'some longer record' * 100]
+    path = os.path.join(self.create_tempdir().full_path, 'records')
+    with tf.io.TFRecordWriter(path) as writer:
+      for r in records:
+        writer.write(r)
+    with tf.io.gfile.GFile(path, 'rb') as f:
+      self.assertEqual(generate_default_trace.frame_records(records), f.read())
+
+  @mock.patch.object(generate_default_trace, '_HAS_NATIVE_CRC32C', True)
+  def test_sharded_writer(self):
+    path = os.path.join(self.create_tempdir().full_path, 'records')
+    with generate_default_trace.ShardedTFRecordWriter(path, 1) as writer:
+      writer.write('a', generate_default_trace.frame_records([b'1', b'2']))
+      writer.write('b', generate_default_trace.frame_records([b'3']))
+    self.assertEqual([r.numpy() for r in tf.data.TFRecordDataset(path)],
+                     [b'1', b'2', b'3'])
+
+  @mock.patch.object(generate_default_trace, '_HAS_NATIVE_CRC32C', False)
+  def test_sharded_writer_without_native_crc32c(self):
+    path = os.path.join(self.create_tempdir().full_path, 'records')
+    with generate_default_trace.ShardedTFRecordWriter(path, 1) as writer:
+      writer.write('a', [b'1', b'2'])
+      writer.write('b', [b'3'])
+    self.assertEqual([r.numpy() for r in tf.data.TFRecordDataset(path)],
+                     [b'1', b'2', b'3'])
+
+  @mock.patch.object(generate_default_trace, '_HAS_NATIVE_CRC32C', False)
+  def test_sharded_writer_stable_shards(self):
+    path = os.path.join(self.create_tempdir().full_path, 'records')
+    with generate_default_trace.ShardedTFRecordWriter(path, 2) as writer:
+      for name in 'abcd':
+        writer.write(name, [name.encode('utf-8')])
+    expected = [[], []]
+    for name in 'abcd':
+      expected[zlib.crc32(name.encode('utf-8')) % 2].append(
+          name.encode('utf-8'))
+    self.assertEqual([[r.numpy()
+                       for r in tf.data.TFRecordDataset(shard)]
+                      for shard in writer.paths], expected)
+
+  def test_sharded_writer_bad_path(self):
+    path = os.path.join(self.create_tempdir().full_path, 'missing', 'records')
+    with self.assertRaises(OSError):
+      generate_default_trace.ShardedTFRecordWriter(path, 2)
+
+  @mock.patch.object(generate_default_trace, '_HAS_NATIVE_CRC32C', True)
+  def test_sharded_writer_stopped_writer(self):
+    path = os.path.join(self.create_tempdir().full_path, 'records')
+    with mock.patch.object(
+        generate_default_trace, '_writev_all', side_effect=OSError('no space')):
+      with self.assertRaisesRegex(OSError, 'no space'):
+        with generate_default_trace.ShardedTFRecordWriter(path, 1) as writer:
+          writer.write('a', b'records')
+          # Wait for the writer thread to fail.
+          writer._futures[0].exception()
+          writer.write('b', b'more records')
+          self.fail('write should have raised.')
+
+  def test_partition_by_size(self):
+    module_specs = [
+        corpus.ModuleSpec(name=str(size), size=size)
+        for size in [2, 7, 3, 5, 4, 4]
+    ]
+    partitions = generate_default_trace.partition_by_size(module_specs, 3)
+    self.assertEqual([[m.size for m in p] for p in partitions],
+                     [[7, 2], [5, 3], [4, 4]])
+
+  def test_work_stealing_queues(self):
+    work_queues = generate_default_trace.WorkStealingQueues(
+        multiprocessing.get_context(), [[1, 2, 3, 4, 5], [6]])
+    self.assertEqual(work_queues.get(1), [6])
+    # Worker 1 is out of work, and steals half of what worker 0 has left.
+    self.assertEqual(work_queues.get(1), [4, 5])
+    self.assertEqual(work_queues.get(0), [1])
+    self.assertEqual(work_queues.get(0), [2])
+    self.assertEqual(work_queues.get(1), [3])
+    self.assertEqual(work_queues.get(0), [])
+    self.assertEqual(work_queues.get(1), [])
+
   def test_get_runner(self):
     runner = generate_default_trace.get_runner()
     self.assertIsInstance(runner, compilation_runner.CompilationRunner)